@@ -1,6 +1,7 @@
 import os, datetime, shutil, hashlib, time, requests, re, mimetypes
 from dataclasses import dataclass
 from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlparse
 from random import randrange
 
@@ -10,9 +11,15 @@ from selenium.common.exceptions import TimeoutException
 from selenium.webdriver.common.by import By
 from slugify import slugify
 
+from configs import WEBDRIVER_LOCK
 from storages import Storage
 from utils import mkdir_if_not_exists
 
+# shared by all archivers so that uploading large media overlaps with local work (hash, thumbnails, screenshot)
+_UPLOAD_POOL = ThreadPoolExecutor(max_workers=4)
+# screenshots only need the url so they can be taken while the media is downloaded, one at a time given WEBDRIVER_LOCK
+_SCREENSHOT_POOL = ThreadPoolExecutor(max_workers=1)
+
 
 @dataclass
 class ArchiveResult:
@@ -75,10 +82,8 @@ class Archiver(ABC):
         with open(page_filename, "w") as f:
             f.write(page)
 
-        page_hash = self.get_hash(page_filename)
-
-        self.storage.upload(page_filename, page_key, extra_args={
-            'ACL': 'public-read', 'ContentType': 'text/html'})
+        page_hash = self.storage.upload(page_filename, page_key, extra_args={
+            'ACL': 'public-read', 'ContentType': 'text/html'}) or self.get_hash(page_filename)
 
         page_cdn = self.storage.get_cdn_url(page_key)
         return (page_cdn, page_hash, thumbnail)
@@ -114,8 +119,7 @@ class Archiver(ABC):
 
             filename = os.path.join(Storage.TMP_FOLDER, key)
             self.download_from_url(media_url, filename)
-            self.storage.upload(filename, key)
-            hash = self.get_hash(filename)
+            hash = self.storage.upload(filename, key) or self.get_hash(filename)
             cdn_url = self.storage.get_cdn_url(key)
 
             if thumbnail is None:
@@ -160,13 +164,51 @@ class Archiver(ABC):
                 slug += with_extension
         return self.get_key(slug)
 
+    def upload_in_background(self, filename, key, **kwargs):
+        """
+        Submits the upload of @filename to @key to the shared upload pool and returns its Future
+        callers must wait on .result() before removing @filename
+        """
+        return _UPLOAD_POOL.submit(self._upload_with_retries, filename, key, **kwargs)
+
+    def _upload_with_retries(self, filename, key, attempts=3, **kwargs):
+        """
+        Uploads @filename to @key, retrying up to @attempts times with exponential backoff
+        """
+        for attempt in range(attempts):
+            try:
+                return self.storage.upload(filename, key, **kwargs)
+            except Exception as e:
+                if attempt == attempts - 1: raise e
+                logger.warning(f'upload of {key=} failed on attempt {attempt + 1}/{attempts}, retrying in {2 ** attempt}s: {e}')
+                time.sleep(2 ** attempt)
+
+    def screenshot_in_background(self, url):
+        """
+        Submits self.get_screenshot(@url) to the screenshot pool and returns its Future
+        """
+        return _SCREENSHOT_POOL.submit(self.get_screenshot, url)
+
+    def discard_screenshot(self, future):
+        """
+        Cancels a screenshot_in_background @future whose result will not be used (eg: the url was rejected or failed),
+        waiting for it instead if it already started so the webdriver is not left mid-page for the next url
+        """
+        if future is None or future.cancel(): return
+        if future.exception() is not None:
+            logger.warning(f"discarded screenshot failed: {future.exception()}")
+
     def get_hash(self, filename):
-        with open(filename, "rb") as f:
-            bytes = f.read()  # read entire file as bytes
-            # TODO: customizable hash
-            hash = hashlib.sha256(bytes)
-            # option to use SHA3_512 instead
-            # hash = hashlib.sha3_512(bytes)
+        # TODO: customizable hash
+        # option to use SHA3_512 instead: hashlib.sha3_512
+        with open(filename, "rb", buffering=0) as f:
+            if hasattr(hashlib, "file_digest"):
+                # python 3.11+ reads and hashes in C
+                return hashlib.file_digest(f, "sha256").hexdigest()
+            hash = hashlib.sha256()
+            # read in chunks rather than the entire file into memory
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                hash.update(chunk)
         return hash.hexdigest()
 
     def get_screenshot(self, url):
@@ -174,26 +216,28 @@ class Archiver(ABC):
         key = self._get_key_from_url(url, ".png", append_datetime=True)
         filename = os.path.join(Storage.TMP_FOLDER, key)
 
-        # Accept cookies popup dismiss for ytdlp video
-        if 'facebook.com' in url:
+        with WEBDRIVER_LOCK:
+            # Accept cookies popup dismiss for ytdlp video
+            if 'facebook.com' in url:
+                try:
+                    logger.debug(f'Trying fb click accept cookie popup for {url}')
+                    self.driver.get("http://www.facebook.com")
+                    foo = self.driver.find_element(By.XPATH, "//button[@data-cookiebanner='accept_only_essential_button']")
+                    foo.click()
+                    logger.debug(f'fb click worked')
+                    # linux server needs a sleep otherwise facebook cookie won't have worked and we'll get a popup on next page
+                    time.sleep(2)
+                except:
+                    logger.warning(f'Failed on fb accept cookies for url {url}')
+
             try:
-                logger.debug(f'Trying fb click accept cookie popup for {url}')
-                self.driver.get("http://www.facebook.com")
-                foo = self.driver.find_element(By.XPATH, "//button[@data-cookiebanner='accept_only_essential_button']")
-                foo.click()
-                logger.debug(f'fb click worked')
-                # linux server needs a sleep otherwise facebook cookie won't have worked and we'll get a popup on next page
-                time.sleep(2)
-            except:
-                logger.warning(f'Failed on fb accept cookies for url {url}')
-
-        try:
-            self.driver.get(url)
-            time.sleep(6)
-        except TimeoutException:
-            logger.info("TimeoutException loading page for screenshot")
-
-        self.driver.save_screenshot(filename)
+                self.driver.get(url)
+                time.sleep(6)
+            except TimeoutException:
+                logger.info("TimeoutException loading page for screenshot")
+
+            self.driver.save_screenshot(filename)
+
         self.storage.upload(filename, key, extra_args={
                             'ACL': 'public-read', 'ContentType': 'image/png'})
 
@@ -216,20 +260,29 @@ class Archiver(ABC):
             else:
                 fps = 40.0 / duration
 
-        stream = ffmpeg.input(filename)
-        stream = ffmpeg.filter(stream, 'fps', fps=fps).filter('scale', 512, -1)
-        stream.output(thumbnails_folder + 'out%d.jpg').run()
+        # select one frame every 1/fps seconds, unlike the fps filter this does not retime (and decode-duplicate) frames
+        select = f"select='isnan(prev_selected_t)+gte(t-prev_selected_t\\,{1 / fps})',scale=512:-1"
+        jpegs, _ = ffmpeg.input(filename).output('pipe:', vf=select, vsync='vfr', format='image2pipe', vcodec='mjpeg').run(capture_stdout=True)
+
+        # split the piped stream on JPEG end/start markers, 0xFF is byte-stuffed inside JPEG data so this only matches at frame boundaries
+        frames = [frame for frame in jpegs.split(b'\xff\xd9\xff\xd8') if len(frame)]
+        frames = [(b'' if i == 0 else b'\xff\xd8') + frame + (b'' if i == len(frames) - 1 else b'\xff\xd9') for i, frame in enumerate(frames)]
+        thumbnails = [f'out{i + 1}.jpg' for i in range(len(frames))]
+
+        def write_frame(fname, frame):
+            with open(thumbnails_folder + fname, 'wb') as f:
+                f.write(frame)
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            list(executor.map(write_frame, thumbnails, frames))
 
-        thumbnails = os.listdir(thumbnails_folder)
         cdn_urls = []
         for fname in thumbnails:
-            if fname[-3:] == 'jpg':
-                thumbnail_filename = thumbnails_folder + fname
-                key = os.path.join(key_folder, fname)
+            thumbnail_filename = thumbnails_folder + fname
+            key = os.path.join(key_folder, fname)
 
-                self.storage.upload(thumbnail_filename, key)
-                cdn_url = self.storage.get_cdn_url(key)
-                cdn_urls.append(cdn_url)
+            self.storage.upload(thumbnail_filename, key)
+            cdn_url = self.storage.get_cdn_url(key)
+            cdn_urls.append(cdn_url)
 
         if len(cdn_urls) == 0:
             return ('', '')
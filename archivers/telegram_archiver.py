@@ -62,10 +62,11 @@ class TelegramArchiver(Archiver):
         with open(filename, 'wb') as f:
             f.write(v.content)
 
+        hash = None
         if status != 'already archived':
-            self.storage.upload(filename, key)
+            hash = self.storage.upload(filename, key)
 
-        hash = self.get_hash(filename)
+        hash = hash or self.get_hash(filename)
 
         # extract duration from HTML
         try:
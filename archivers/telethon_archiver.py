@@ -97,8 +97,7 @@ class TelethonArchiver(Archiver):
                             filename = os.path.join(Storage.TMP_FOLDER, f'{chat}_{group_id}_{self._get_key_from_url(om_url)}')
                             self.download_from_url(om_url, filename)
                             key = filename.split(Storage.TMP_FOLDER)[1]
-                            self.storage.upload(filename, key)
-                            hash = self.get_hash(filename)
+                            hash = self.storage.upload(filename, key) or self.get_hash(filename)
                             cdn_url = self.storage.get_cdn_url(key)
                             uploaded_media.append({'cdn_url': cdn_url, 'key': key, 'hash': hash})
 
@@ -109,8 +108,7 @@ class TelethonArchiver(Archiver):
                         continue
 
                     key = filename.split(Storage.TMP_FOLDER)[1]
-                    self.storage.upload(filename, key)
-                    hash = self.get_hash(filename)
+                    hash = self.storage.upload(filename, key) or self.get_hash(filename)
                     cdn_url = self.storage.get_cdn_url(key)
                     uploaded_media.append({'cdn_url': cdn_url, 'key': key, 'hash': hash})
                     if key_thumb is None:
@@ -1,4 +1,6 @@
-import os, traceback
+import os, traceback, tempfile, shutil, errno
+from concurrent.futures import ThreadPoolExecutor, wait
+
 import tiktok_downloader
 from loguru import logger
 
@@ -8,36 +10,52 @@ from storages import Storage
 
 class TiktokArchiver(Archiver):
     name = "tiktok"
+    # tmpfs folder used when available so the small videos, read several times (thumbnails, upload, hash), stay in RAM
+    RAM_FOLDER = "/dev/shm"
+    # larger videos go to Storage.TMP_FOLDER instead, as does everything when RAM_FOLDER has less free space than this
+    RAM_MAX_BYTES = 64 * 1024 * 1024
 
     def download(self, url, check_if_exists=False):
         if 'tiktok.com' not in url:
             return False
 
         status = 'success'
+        # started once the url is known to have media, discarded if anything below bails out before using it
+        screenshot_future = None
+        upload_future = None
+        work_folder = None
 
         try:
-            info = tiktok_downloader.info_post(url)
+            # the post info and the media are fetched from different services, so do both at once
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                info_future = executor.submit(tiktok_downloader.info_post, url)
+                media_future = executor.submit(lambda: tiktok_downloader.snaptik(url).get_media())
+                # result() re-raises errors such as InvalidUrl from the fetching thread
+                info = info_future.result()
+                media = media_future.result()
+
             key = self.get_key(f'{info.id}.mp4')
-            filename = os.path.join(Storage.TMP_FOLDER, key)
             logger.info(f'found video {key=}')
 
             if check_if_exists and self.storage.exists(key):
                 status = 'already archived'
 
-            media = tiktok_downloader.snaptik(url).get_media()
-
             if len(media) <= 0:
                 if status == 'already archived':
                     return ArchiveResult(status='Could not download media, but already archived', cdn_url=self.storage.get_cdn_url(key))
                 else:
                     return ArchiveResult(status='Could not download media')
 
+            # screenshot while the media is downloaded and processed
+            screenshot_future = self.screenshot_in_background(url)
+
             logger.info(f'downloading video {key=}')
-            media[0].download(filename)
+            work_folder, filename = self._download_media(media[0], key)
 
             if status != 'already archived':
                 logger.info(f'uploading video {key=}')
-                self.storage.upload(filename, key)
+                # upload in the background while the local file is thumbnailed, the upload also hashes it
+                upload_future = self.upload_in_background(filename, key)
 
             try:
                 key_thumb, thumb_index = self.get_thumbnails(filename, key, duration=info.duration)
@@ -46,8 +64,11 @@ class TiktokArchiver(Archiver):
                 key_thumb = ''
                 thumb_index = 'error creating thumbnails'
 
-            hash = self.get_hash(filename)
-            screenshot = self.get_screenshot(url)
+            hash = upload_future.result() if upload_future is not None else None
+            if hash is None:
+                hash = self.get_hash(filename)
+
+            screenshot = screenshot_future.result()
 
             try: os.remove(filename)
             except FileNotFoundError:
@@ -69,3 +90,40 @@ class TiktokArchiver(Archiver):
             status = 'Other Tiktok error: ' + str(error)
             logger.warning(f'Other Tiktok error' + str(error))
             return ArchiveResult(status=status)
+
+        finally:
+            self.discard_screenshot(screenshot_future)
+            # an upload that was not awaited because something above raised may still be reading from the work folder
+            if upload_future is not None: wait([upload_future])
+            # tmpfs is not cleaned with Storage.TMP_FOLDER, so always remove the work folder
+            if work_folder is not None: shutil.rmtree(work_folder, ignore_errors=True)
+
+    def _download_media(self, media, key):
+        """
+        Downloads @media as @key into a new work folder and returns (work_folder, filename)
+        The work folder is in RAM_FOLDER if it has room for RAM_MAX_BYTES, falling back to Storage.TMP_FOLDER when RAM runs out
+        mid-download, and videos larger than RAM_MAX_BYTES are moved to Storage.TMP_FOLDER so they do not hold on to RAM
+        """
+        if os.path.isdir(TiktokArchiver.RAM_FOLDER) and shutil.disk_usage(TiktokArchiver.RAM_FOLDER).free > TiktokArchiver.RAM_MAX_BYTES:
+            work_folder = tempfile.mkdtemp(dir=TiktokArchiver.RAM_FOLDER)
+            filename = os.path.join(work_folder, key)
+            try:
+                media.download(filename)
+            except OSError as e:
+                shutil.rmtree(work_folder, ignore_errors=True)
+                # only running out of RAM is worth a retry on disk, network errors from the download are OSErrors too
+                if e.errno != errno.ENOSPC: raise
+                logger.warning(f'could not download {key=} to {TiktokArchiver.RAM_FOLDER}, retrying in {Storage.TMP_FOLDER}: {e}')
+            else:
+                if os.path.getsize(filename) <= TiktokArchiver.RAM_MAX_BYTES:
+                    return work_folder, filename
+                logger.debug(f'{key=} is too large to keep in RAM, moving it to {Storage.TMP_FOLDER}')
+                disk_folder = tempfile.mkdtemp(dir=Storage.TMP_FOLDER)
+                try: shutil.move(filename, disk_folder)
+                finally: shutil.rmtree(work_folder, ignore_errors=True)
+                return disk_folder, os.path.join(disk_folder, key)
+
+        work_folder = tempfile.mkdtemp(dir=Storage.TMP_FOLDER)
+        filename = os.path.join(work_folder, key)
+        media.download(filename)
+        return work_folder, filename
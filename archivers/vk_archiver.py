@@ -54,8 +54,7 @@ class VkArchiver(Archiver):
         filenames = self.vks.download_media(results, Storage.TMP_FOLDER)
         for filename in filenames:
             key = self.get_key(filename)
-            self.storage.upload(filename, key)
-            hash = self.get_hash(filename)
+            hash = self.storage.upload(filename, key) or self.get_hash(filename)
             cdn_url = self.storage.get_cdn_url(key)
             try:
                 _type = mimetypes.guess_type(filename)[0].split("/")[0]
@@ -6,35 +6,200 @@ from loguru import logger
 
 from .base_archiver import Archiver, ArchiveResult
 from storages import Storage
+from utils import MetadataCache
 
 
 class YoutubeDLArchiver(Archiver):
     name = "youtube_dl"
-    ydl_opts = {'outtmpl': f'{Storage.TMP_FOLDER}%(id)s.%(ext)s', 'quiet': False}
+    # live streams are skipped by the match_filter so a single extract_info(download=True) never records them
+    ydl_opts = {'outtmpl': f'{Storage.TMP_FOLDER}%(id)s.%(ext)s', 'quiet': False, 'match_filter': yt_dlp.utils.match_filter_func('!is_live')}
+    # how long probed metadata is reused, and which fields are kept (enough to validate and prepare_filename)
+    metadata_ttl = 86400
+    metadata_fields = ['id', 'ext', 'title', 'duration', 'timestamp', 'upload_date', 'is_live', 'webpage_url']
 
     def __init__(self, storage: Storage, driver, fb_cookie):
         super().__init__(storage, driver)
         self.fb_cookie = fb_cookie
+        # long-lived YoutubeDL instance reused across downloads to avoid bootstrapping extractors on every url
+        self.ydl = yt_dlp.YoutubeDL(YoutubeDLArchiver.ydl_opts)
+        self._probed = None
+        self.metadata_cache = MetadataCache.shared(max_age=YoutubeDLArchiver.metadata_ttl)
 
     def download(self, url, check_if_exists=False):
         netloc = self.get_netloc(url)
         if netloc in ['facebook.com', 'www.facebook.com'] and self.fb_cookie:
             logger.debug('Using Facebook cookie')
             yt_dlp.utils.std_headers['cookie'] = self.fb_cookie
+            # the long-lived YoutubeDL may have copied std_headers on creation
+            self.ydl.params.get('http_headers', {})['cookie'] = self.fb_cookie
 
-        ydl = yt_dlp.YoutubeDL(YoutubeDLArchiver.ydl_opts)
+        ydl = self.ydl
         cdn_url = None
         status = 'success'
+        # started once the url is known to be worth archiving, discarded if anything below bails out before using it
+        screenshot_future = None
 
         try:
-            info = ydl.extract_info(url, download=False)
+            if check_if_exists or 'twitter.com' in netloc:
+                # probe before downloading: the existence check needs the filename and twitter's linked video check needs the webpage_url
+                # a cache hit saves the probe for urls rejected below, accepted ones are extracted again by _download_probed
+                # live streams are not cached since they become downloadable once they end
+                info = self.metadata_cache.get_or_compute(url, ttl=YoutubeDLArchiver.metadata_ttl, fn=lambda: self._probe_info(url),
+                                                          cache_if=lambda i: not i.get('is_live', False))
+                if info is None: return False
+                invalid = self._validate_info(info, netloc)
+                if invalid is not None: return invalid
+
+                if 'entries' in info:
+                    if len(info['entries']) > 1:
+                        logger.warning('YoutubeDLArchiver succeeded but cannot archive channels or pages with multiple videos')
+                        return False
+                    elif len(info['entries']) == 0:
+                        logger.warning(
+                            'YoutubeDLArchiver succeeded but did not find video')
+                        return False
+
+                    filename = ydl.prepare_filename(info['entries'][0])
+                else:
+                    filename = ydl.prepare_filename(info)
+
+                # the url is worth archiving, so screenshot it while the media is downloaded
+                screenshot_future = self.screenshot_in_background(url)
+
+                if check_if_exists:
+                    key = self.get_key(filename)
+
+                    if self.storage.exists(key):
+                        status = 'already archived'
+                        cdn_url = self.storage.get_cdn_url(key)
+
+                # sometimes downloading results in a different filename, so use the info it returns
+                info = self._download_probed(url)
+            else:
+                # no existence check needed so extract and download in a single pass
+                info = self._extract_info(url, download=True)
+                if info is None: return False
+                invalid = self._validate_info(info, netloc)
+                if invalid is not None:
+                    self._remove_downloaded(info)
+                    return invalid
+                # screenshot while the media is uploaded and thumbnailed
+                screenshot_future = self.screenshot_in_background(url)
+
+            # TODO: add support for multiple videos
+            if 'entries' in info:
+                if len(info['entries']) > 1:
+                    logger.warning(
+                        'YoutubeDLArchiver cannot archive channels or pages with multiple videos')
+                    self._remove_downloaded(info)
+                    return False
+                else:
+                    info = info['entries'][0]
+
+            filename = ydl.prepare_filename(info)
+
+            if not os.path.exists(filename):
+                filename = filename.split('.')[0] + '.mkv'
+
+            upload_future = None
+            if status != 'already archived':
+                key = self.get_key(filename)
+                # upload in the background while the local file is thumbnailed, the upload also hashes it
+                upload_future = self.upload_in_background(filename, key)
+
+            # get duration
+            duration = info.get('duration')
+
+            # get thumbnails
+            try:
+                key_thumb, thumb_index = self.get_thumbnails(filename, key, duration=duration)
+            except:
+                key_thumb = ''
+                thumb_index = 'Could not generate thumbnails'
+
+            hash = None
+            if upload_future is not None:
+                hash = upload_future.result()
+                # filename ='tmp/sDE-qZdi8p8.webm'
+                # key ='SM0022/youtube_dl_sDE-qZdi8p8.webm'
+                cdn_url = self.storage.get_cdn_url(key)
+
+            if hash is None:
+                hash = self.get_hash(filename)
+            os.remove(filename)
+            screenshot = screenshot_future.result()
+
+            timestamp = None
+            if 'timestamp' in info and info['timestamp'] is not None:
+                timestamp = datetime.datetime.utcfromtimestamp(info['timestamp']).replace(tzinfo=datetime.timezone.utc).isoformat()
+            elif 'upload_date' in info and info['upload_date'] is not None:
+                timestamp = datetime.datetime.strptime(info['upload_date'], '%Y%m%d').replace(tzinfo=datetime.timezone.utc)
+
+            return ArchiveResult(status=status, cdn_url=cdn_url, thumbnail=key_thumb, thumbnail_index=thumb_index, duration=duration,
+                                 title=info['title'] if 'title' in info else None, timestamp=timestamp, hash=hash, screenshot=screenshot)
+        finally:
+            self.discard_screenshot(screenshot_future)
+
+    def _extract_info(self, url, download):
+        """
+        Returns the yt-dlp info dict for @url, or None if yt-dlp cannot handle it
+        When @download, errors other than extractor ones (ie: the video was found but downloading it failed) are raised
+        """
+        try:
+            return self.ydl.extract_info(url, download=download)
         except yt_dlp.utils.DownloadError as e:
+            if download and not isinstance(e.exc_info[1] if e.exc_info else None, yt_dlp.utils.ExtractorError):
+                logger.warning(f'ytdlp found a video at {url} but could not download it: {e}')
+                raise
             logger.debug(f'No video - Youtube normal control flow: {e}')
-            return False
         except Exception as e:
+            if download:
+                logger.warning(f'ytdlp exception while downloading {url}: {e}')
+                return None
             logger.debug(f'ytdlp exception which is normal for example a facebook page with images only will cause a IndexError: list index out of range. Exception here is: \n  {e}')
-            return False
-
+        return None
+
+    def _probe_info(self, url):
+        """
+        Extracts @url's info without downloading, trimmed to metadata_fields so it can be cached
+        """
+        info = self._extract_info(url, download=False)
+        if info is None: return None
+        # kept so that _download_probed does not need to extract it again
+        self._probed = (url, info)
+
+        def trim(i): return {f: i[f] for f in YoutubeDLArchiver.metadata_fields if f in i}
+        trimmed = trim(info)
+        if 'entries' in info:
+            trimmed['entries'] = [trim(entry) for entry in info['entries']]
+        return trimmed
+
+    def _download_probed(self, url):
+        """
+        Downloads @url reusing the info extracted by _probe_info instead of hitting the site again
+        Falls back to a new extraction if the info came from the metadata cache or its format urls have expired
+        """
+        probed, self._probed = self._probed, None
+        if probed is not None and probed[0] == url:
+            try:
+                return self.ydl.process_ie_result(self.ydl.sanitize_info(probed[1]), download=True)
+            except (yt_dlp.utils.DownloadError, yt_dlp.utils.ExtractorError) as e:
+                logger.debug(f'could not download from the probed info, extracting {url} again: {e}')
+        return self.ydl.extract_info(url, download=True)
+
+    def _remove_downloaded(self, info):
+        """
+        Removes the local files downloaded for @info (or its entries) when they are not going to be archived
+        """
+        for entry in info.get('entries') or [info]:
+            filename = self.ydl.prepare_filename(entry)
+            for f in [filename, filename.split('.')[0] + '.mkv']:
+                if os.path.exists(f): os.remove(f)
+
+    def _validate_info(self, info, netloc):
+        """
+        Returns the value download should return if @info must not be archived, None otherwise
+        """
         if info.get('is_live', False):
             logger.warning("Live streaming media, not archiving now")
             return ArchiveResult(status="Streaming media")
@@ -45,72 +210,4 @@ class YoutubeDLArchiver(Archiver):
             else:
                 logger.info('Found a linked video probably in a link in a tweet - not getting that video as there may be images in the tweet')
                 return False
-
-        if check_if_exists:
-            if 'entries' in info:
-                if len(info['entries']) > 1:
-                    logger.warning('YoutubeDLArchiver succeeded but cannot archive channels or pages with multiple videos')
-                    return False
-                elif len(info['entries']) == 0:
-                    logger.warning(
-                        'YoutubeDLArchiver succeeded but did not find video')
-                    return False
-
-                filename = ydl.prepare_filename(info['entries'][0])
-            else:
-                filename = ydl.prepare_filename(info)
-
-            key = self.get_key(filename)
-
-            if self.storage.exists(key):
-                status = 'already archived'
-                cdn_url = self.storage.get_cdn_url(key)
-
-        # sometimes this results in a different filename, so do this again
-        info = ydl.extract_info(url, download=True)
-
-        # TODO: add support for multiple videos
-        if 'entries' in info:
-            if len(info['entries']) > 1:
-                logger.warning(
-                    'YoutubeDLArchiver cannot archive channels or pages with multiple videos')
-                return False
-            else:
-                info = info['entries'][0]
-
-        filename = ydl.prepare_filename(info)
-
-        if not os.path.exists(filename):
-            filename = filename.split('.')[0] + '.mkv'
-
-        if status != 'already archived':
-            key = self.get_key(filename)
-            self.storage.upload(filename, key)
-
-            # filename ='tmp/sDE-qZdi8p8.webm'
-            # key ='SM0022/youtube_dl_sDE-qZdi8p8.webm'
-            cdn_url = self.storage.get_cdn_url(key)
-
-        hash = self.get_hash(filename)
-        screenshot = self.get_screenshot(url)
-
-        # get duration
-        duration = info.get('duration')
-
-        # get thumbnails
-        try:
-            key_thumb, thumb_index = self.get_thumbnails(filename, key, duration=duration)
-        except:
-            key_thumb = ''
-            thumb_index = 'Could not generate thumbnails'
-
-        os.remove(filename)
-
-        timestamp = None
-        if 'timestamp' in info and info['timestamp'] is not None:
-            timestamp = datetime.datetime.utcfromtimestamp(info['timestamp']).replace(tzinfo=datetime.timezone.utc).isoformat()
-        elif 'upload_date' in info and info['upload_date'] is not None:
-            timestamp = datetime.datetime.strptime(info['upload_date'], '%Y%m%d').replace(tzinfo=datetime.timezone.utc)
-
-        return ArchiveResult(status=status, cdn_url=cdn_url, thumbnail=key_thumb, thumbnail_index=thumb_index, duration=duration,
-                             title=info['title'] if 'title' in info else None, timestamp=timestamp, hash=hash, screenshot=screenshot)
+        return None
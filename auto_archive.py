@@ -68,6 +68,19 @@ def process_sheet(c: Config):
         c.set_folder(default_folder)
         storage = c.get_storage()
 
+        # archivers are reused across rows so their clients (eg: YoutubeDL) are only bootstrapped once per worksheet
+        # order matters, first to succeed excludes remaining
+        active_archivers = [
+            TelethonArchiver(storage, c.webdriver, c.telegram_config),
+            TiktokArchiver(storage, c.webdriver),
+            TwitterApiArchiver(storage, c.webdriver, c.twitter_config),
+            YoutubeDLArchiver(storage, c.webdriver, c.facebook_cookie),
+            TelegramArchiver(storage, c.webdriver),
+            TwitterArchiver(storage, c.webdriver),
+            VkArchiver(storage,  c.webdriver, c.vk_config),
+            WaybackArchiver(storage, c.webdriver, c.wayback_config)
+        ]
+
         # loop through rows in worksheet
         for row in range(1 + c.header, gw.count_rows() + 1):
             url = gw.get_cell(row, 'url')
@@ -85,23 +98,12 @@ def process_sheet(c: Config):
                 url = expand_url(url)
                 c.set_folder(gw.get_cell_or_default(row, 'folder', default_folder, when_empty_use_default=True))
 
-                # make a new driver so each spreadsheet row is idempotent
-                c.recreate_webdriver()
-
-                # order matters, first to succeed excludes remaining
-                active_archivers = [
-                    TelethonArchiver(storage, c.webdriver, c.telegram_config),
-                    TiktokArchiver(storage, c.webdriver),
-                    TwitterApiArchiver(storage, c.webdriver, c.twitter_config),
-                    YoutubeDLArchiver(storage, c.webdriver, c.facebook_cookie),
-                    TelegramArchiver(storage, c.webdriver),
-                    TwitterArchiver(storage, c.webdriver),
-                    VkArchiver(storage,  c.webdriver, c.vk_config),
-                    WaybackArchiver(storage, c.webdriver, c.wayback_config)
-                ]
+                # clear the driver's cookies (for the current site) and local/session storage between rows, it is only recreated if broken
+                c.reset_webdriver_state()
 
                 for archiver in active_archivers:
                     logger.debug(f'Trying {archiver} on {row=}')
+                    archiver.driver = c.webdriver
 
                     try:
                         result = archiver.download(url, check_if_exists=c.check_if_exists)
@@ -1,5 +1,5 @@
 from .config import Config
-from .selenium_config import SeleniumConfig
+from .selenium_config import SeleniumConfig, WEBDRIVER_LOCK
 from .telethon_config import TelethonConfig
 from .wayback_config import WaybackConfig
 from .twitter_api_config import TwitterApiConfig
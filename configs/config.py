@@ -1,18 +1,23 @@
 
-import argparse, yaml, json
-import gspread
+import argparse, yaml, json, sys
+from functools import cached_property
+from contextlib import contextmanager
 from loguru import logger
-from selenium import webdriver
 from dataclasses import asdict
-from selenium.common.exceptions import TimeoutException
 
 from utils import GWorksheet, getattr_or
 from .wayback_config import WaybackConfig
 from .telethon_config import TelethonConfig
-from .selenium_config import SeleniumConfig
+from .selenium_config import SeleniumConfig, WEBDRIVER_LOCK
 from .vk_config import VkConfig
 from .twitter_api_config import TwitterApiConfig
-from storages import S3Config, S3Storage, GDStorage, GDConfig, LocalStorage, LocalConfig
+from storages import LocalStorage, LocalConfig
+
+try:
+    # libyaml bindings are much faster than the pure-python loader
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
 
 
 class Config:
@@ -25,7 +30,7 @@ class Config:
     All the configurations available as cmd line options, when included, will 
     override the configurations in the config.yaml file.
     Configurations are split between:
-    1. "secrets" containing API keys for generating services - not kept in memory
+    1. "secrets" containing API keys for generating services - only kept in memory until first used
     2. "execution" containing specific execution configurations
     """
     AVAILABLE_STORAGES = {"s3", "gd", "local"}
@@ -43,7 +48,7 @@ class Config:
 
     def read_config_yaml(self):
         with open(self.config_file, "r", encoding="utf-8") as inf:
-            self.config = yaml.safe_load(inf)
+            self.config = yaml.load(inf, Loader=SafeLoader)
 
         # ----------------------EXECUTION - execution configurations
         execution = self.config.get("execution", {})
@@ -74,24 +79,40 @@ class Config:
         self.webdriver = "not initialized"
 
         # ---------------------- SECRETS - APIs and service configurations
-        secrets = self.config.get("secrets", {})
+        # secrets are only turned into service configurations/clients when first used, see the properties below
+        self._secrets = self.config.pop("secrets", {})
 
         # assert selected storage credentials exist
         for key, name in [("s3", "s3"), ("gd", "google_drive"), ("local", "local")]:
-            assert self.storage != key or name in secrets, f"selected storage '{key}' requires secrets.'{name}' in {self.config_file}"
-
-        # google sheets config
-        self.gsheets_client = gspread.service_account(
-            filename=secrets.get("google_sheets", {}).get("service_account", 'service_account.json')
-        )
+            assert self.storage != key or name in self._secrets, f"selected storage '{key}' requires secrets.'{name}' in {self.config_file}"
 
         # facebook config
-        self.facebook_cookie = secrets.get("facebook", {}).get("cookie", None)
+        self.facebook_cookie = self._secrets.pop("facebook", {}).get("cookie", None)
 
-        # s3 config
-        if "s3" in secrets:
-            s3 = secrets["s3"]
-            self.s3_config = S3Config(
+    @contextmanager
+    def _consume_secret(self, name):
+        """
+        yields the @name section of the secrets and removes it once the block using it succeeds, so each is only kept in memory until used
+        if building the configuration/client fails the section is kept and the property can be retried
+        """
+        yield self._secrets.get(name)
+        self._secrets.pop(name, None)
+
+    @cached_property
+    def gsheets_client(self):
+        import gspread
+        with self._consume_secret("google_sheets") as google_sheets:
+            google_sheets = google_sheets or {}
+            return gspread.service_account(
+                filename=google_sheets.get("service_account", 'service_account.json')
+            )
+
+    @cached_property
+    def s3_config(self):
+        from storages import S3Config
+        with self._consume_secret("s3") as s3:
+            if s3 is None: raise AttributeError("'s3' key not present in the secrets")
+            return S3Config(
                 bucket=s3["bucket"],
                 region=s3["region"],
                 key=s3["key"],
@@ -99,67 +120,77 @@ class Config:
                 endpoint_url=s3.get("endpoint_url", S3Config.endpoint_url),
                 cdn_url=s3.get("cdn_url", S3Config.cdn_url),
                 key_path=s3.get("key_path", S3Config.key_path),
-                private=getattr_or(self.args, "s3-private", s3.get("private", S3Config.private))
+                private=getattr_or(self.args, "s3-private", s3.get("private", S3Config.private)),
+                folder=self.folder
             )
 
-        # GDrive config
-        if "google_drive" in secrets:
-            gd = secrets["google_drive"]
-            self.gd_config = GDConfig(
+    @cached_property
+    def gd_config(self):
+        from storages import GDConfig
+        with self._consume_secret("google_drive") as gd:
+            if gd is None: raise AttributeError("'google_drive' key not present in the secrets")
+            return GDConfig(
                 root_folder_id=gd.get("root_folder_id"),
-                service_account=gd.get("service_account", GDConfig.service_account)
+                service_account=gd.get("service_account", GDConfig.service_account),
+                folder=self.folder
             )
 
-        if "local" in secrets:
-            self.local_config = LocalConfig(
-                save_to=secrets["local"].get("save_to", LocalConfig.save_to),
+    @cached_property
+    def local_config(self):
+        with self._consume_secret("local") as local:
+            if local is None: raise AttributeError("'local' key not present in the secrets")
+            return LocalConfig(
+                save_to=local.get("save_to", LocalConfig.save_to),
+                folder=self.folder
             )
 
-        # wayback machine config
-        if "wayback" in secrets:
-            self.wayback_config = WaybackConfig(
-                key=secrets["wayback"]["key"],
-                secret=secrets["wayback"]["secret"],
-            )
-        else:
-            self.wayback_config = None
-            logger.debug(f"'wayback' key not present in the {self.config_file=}")
-
-        # telethon config
-        if "telegram" in secrets:
-            self.telegram_config = TelethonConfig(
-                api_id=secrets["telegram"]["api_id"],
-                api_hash=secrets["telegram"]["api_hash"],
-                bot_token=secrets["telegram"].get("bot_token", None)
+    @cached_property
+    def wayback_config(self):
+        with self._consume_secret("wayback") as wayback:
+            if wayback is None:
+                logger.debug(f"'wayback' key not present in the {self.config_file=}")
+                return None
+            return WaybackConfig(
+                key=wayback["key"],
+                secret=wayback["secret"],
             )
-        else:
-            self.telegram_config = None
-            logger.debug(f"'telegram' key not present in the {self.config_file=}")
-
-        # twitter config
-        if "twitter" in secrets:
-            self.twitter_config = TwitterApiConfig(
-                bearer_token=secrets["twitter"].get("bearer_token"),
-                consumer_key=secrets["twitter"].get("consumer_key"),
-                consumer_secret=secrets["twitter"].get("consumer_secret"),
-                access_token=secrets["twitter"].get("access_token"),
-                access_secret=secrets["twitter"].get("access_secret"),
+
+    @cached_property
+    def telegram_config(self):
+        with self._consume_secret("telegram") as telegram:
+            if telegram is None:
+                logger.debug(f"'telegram' key not present in the {self.config_file=}")
+                return None
+            return TelethonConfig(
+                api_id=telegram["api_id"],
+                api_hash=telegram["api_hash"],
+                bot_token=telegram.get("bot_token", None)
             )
-        else:
-            self.twitter_config = None
-            logger.debug(f"'twitter' key not present in the {self.config_file=}")
-
-        # vk config
-        if "vk" in secrets:
-            self.vk_config = VkConfig(
-                username=secrets["vk"]["username"],
-                password=secrets["vk"]["password"]
+
+    @cached_property
+    def twitter_config(self):
+        with self._consume_secret("twitter") as twitter:
+            if twitter is None:
+                logger.debug(f"'twitter' key not present in the {self.config_file=}")
+                return None
+            return TwitterApiConfig(
+                bearer_token=twitter.get("bearer_token"),
+                consumer_key=twitter.get("consumer_key"),
+                consumer_secret=twitter.get("consumer_secret"),
+                access_token=twitter.get("access_token"),
+                access_secret=twitter.get("access_secret"),
             )
-        else:
-            self.vk_config = None
-            logger.debug(f"'vk' key not present in the {self.config_file=}")
 
-        del self.config["secrets"]  # delete to prevent leaks
+    @cached_property
+    def vk_config(self):
+        with self._consume_secret("vk") as vk:
+            if vk is None:
+                logger.debug(f"'vk' key not present in the {self.config_file=}")
+                return None
+            return VkConfig(
+                username=vk["username"],
+                password=vk["password"]
+            )
 
     def set_log_files(self):
         # called only when config.execution.save_logs=true
@@ -183,6 +214,10 @@ class Config:
         parser.add_argument('--save-logs', action='store_true', dest='save_logs', help='creates or appends execution logs to files logs/LEVEL.log [exceution.save_logs]')
         parser.add_argument('--s3-private', action='store_true', help='Store content without public access permission (only for storage=s3) [secrets.s3.private in config.yaml]')
 
+        # column name options are only registered when used (or to display --help)
+        if not any(arg.startswith('--col-') or arg in ['-h', '--help'] for arg in sys.argv[1:]):
+            return parser
+
         for k, v in GWorksheet.COLUMN_NAMES.items():
             help = f"the name of the column to FILL WITH {k} (default='{v}')"
             if k in ["url", "folder"]:
@@ -196,52 +231,99 @@ class Config:
         update the folder in each of the storages
         """
         self.folder = folder
+        # configs not yet initialized will pick up self.folder when they are
         # s3
-        if hasattr(self, "s3_config"): self.s3_config.folder = folder
+        if "s3_config" in self.__dict__: self.s3_config.folder = folder
         if hasattr(self, "s3_storage"): self.s3_storage.folder = folder
         # gdrive
-        if hasattr(self, "gd_config"): self.gd_config.folder = folder
+        if "gd_config" in self.__dict__: self.gd_config.folder = folder
         if hasattr(self, "gd_storage"): self.gd_storage.folder = folder
         # local
-        if hasattr(self, "local_config"): self.local_config.folder = folder
+        if "local_config" in self.__dict__: self.local_config.folder = folder
         if hasattr(self, "local_storage"): self.local_storage.folder = folder
 
     def get_storage(self):
         """
         returns the configured type of storage, creating if needed
         """
+        # S3 and Google Drive clients are heavy imports, only done for the selected storage
         if self.storage == "s3":
-            self.s3_storage = getattr_or(self, "s3_storage", S3Storage(self.s3_config))
+            from storages import S3Storage
+            if not hasattr(self, "s3_storage"): self.s3_storage = S3Storage(self.s3_config)
             return self.s3_storage
         elif self.storage == "gd":
-            self.gd_storage = getattr_or(self, "gd_storage", GDStorage(self.gd_config))
+            from storages import GDStorage
+            if not hasattr(self, "gd_storage"): self.gd_storage = GDStorage(self.gd_config)
             return self.gd_storage
         elif self.storage == "local":
-            self.local_storage = getattr_or(self, "local_storage", LocalStorage(self.local_config))
+            if not hasattr(self, "local_storage"): self.local_storage = LocalStorage(self.local_config)
             return self.local_storage
         raise f"storage {self.storage} not implemented, available: {Config.AVAILABLE_STORAGES}"
 
     def destroy_webdriver(self):
-        if self.webdriver is not None and type(self.webdriver) != str:
-            self.webdriver.close()
-            self.webdriver.quit()
-            del self.webdriver
+        with WEBDRIVER_LOCK:
+            if self.webdriver is not None and type(self.webdriver) != str:
+                self._quit_webdriver(self.webdriver)
+                self.webdriver = None
+
+    @staticmethod
+    def _quit_webdriver(driver):
+        """
+        best effort close and quit of @driver, a dead driver raises on close() but quit() still stops its geckodriver/firefox
+        """
+        try: driver.close()
+        except Exception as e: logger.warning(f"failed to close webdriver: {e}")
+        try: driver.quit()
+        except Exception as e: logger.warning(f"failed to quit webdriver: {e}")
+
+    def reset_webdriver_state(self):
+        """
+        clears the running webdriver's cookies (webdriver can only reach those of the current site) and local/session storage,
+        much cheaper than recreate_webdriver which is only used if there is no working driver
+        """
+        with WEBDRIVER_LOCK:
+            if self.webdriver is None or type(self.webdriver) == str:
+                return self.recreate_webdriver()
+            try:
+                self.webdriver.delete_all_cookies()
+                self.webdriver.execute_script("try { window.localStorage.clear(); window.sessionStorage.clear(); } catch (e) {}")
+                self.webdriver.get('about:blank')
+            except Exception as e:
+                # a dead geckodriver raises urllib3/socket errors rather than WebDriverException
+                logger.warning(f"failed to reset webdriver state, recreating it: {e}")
+                self.recreate_webdriver()
 
     def recreate_webdriver(self):
+        from selenium import webdriver
+        from selenium.common.exceptions import TimeoutException
         options = webdriver.FirefoxOptions()
         options.headless = True
         options.set_preference('network.protocol-handler.external.tg', False)
         try:
             new_webdriver = webdriver.Firefox(options=options)
-            # only destroy if creation is successful
-            self.destroy_webdriver()
-            self.webdriver = new_webdriver
-            self.webdriver.set_window_size(self.selenium_config.window_width,
-                                           self.selenium_config.window_height)
-            self.webdriver.set_page_load_timeout(self.selenium_config.timeout_seconds)
+            try:
+                new_webdriver.set_window_size(self.selenium_config.window_width,
+                                              self.selenium_config.window_height)
+                new_webdriver.set_page_load_timeout(self.selenium_config.timeout_seconds)
+            except:
+                # a driver that is never swapped in would otherwise leave its firefox running
+                self._quit_webdriver(new_webdriver)
+                raise
+            # only destroy if creation is successful, swapping drivers while no screenshot is using the old one
+            with WEBDRIVER_LOCK:
+                self.destroy_webdriver()
+                self.webdriver = new_webdriver
         except TimeoutException as e:
             logger.error(f"failed to get new webdriver, possibly due to insufficient system resources or timeout settings: {e}")
 
+    def _is_configured(self, prop, secret=None):
+        """
+        whether the lazy @prop is available, without initializing it
+        @secret is None for props that have defaults and do not need their secret
+        """
+        if prop in self.__dict__: return self.__dict__[prop] is not None
+        return secret is None or secret in self._secrets
+
     def __str__(self) -> str:
         return json.dumps({
             "config_file": self.config_file,
@@ -252,14 +334,14 @@ class Config:
             "save_logs": self.save_logs,
             "selenium_config": asdict(self.selenium_config),
             "selenium_webdriver": self.webdriver != None,
-            "s3_config": hasattr(self, "s3_config"),
-            "s3_private": getattr_or(getattr(self, "s3_config", {}), "private", None),
-            "gd_config": hasattr(self, "gd_config"),
-            "local_config": hasattr(self, "local_config"),
-            "wayback_config": self.wayback_config != None,
-            "telegram_config": self.telegram_config != None,
-            "twitter_config": self.twitter_config != None,
-            "vk_config": self.vk_config != None,
-            "gsheets_client": self.gsheets_client != None,
+            "s3_config": self._is_configured("s3_config", "s3"),
+            "s3_private": getattr_or(self.__dict__.get("s3_config"), "private", None),
+            "gd_config": self._is_configured("gd_config", "google_drive"),
+            "local_config": self._is_configured("local_config", "local"),
+            "wayback_config": self._is_configured("wayback_config", "wayback"),
+            "telegram_config": self._is_configured("telegram_config", "telegram"),
+            "twitter_config": self._is_configured("twitter_config", "twitter"),
+            "vk_config": self._is_configured("vk_config", "vk"),
+            "gsheets_client": self._is_configured("gsheets_client"),
             "column_names": self.column_names,
         }, ensure_ascii=False, indent=4)
@@ -1,5 +1,9 @@
+import threading
 from dataclasses import dataclass
 
+# guards the single selenium webdriver shared by Config and the archivers, reentrant as recreate_webdriver calls destroy_webdriver
+WEBDRIVER_LOCK = threading.RLock()
+
 
 @dataclass
 class SeleniumConfig:
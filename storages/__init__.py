@@ -1,5 +1,19 @@
 # we need to explicitly expose the available imports here
+import importlib
+
 from .base_storage import Storage
 from .local_storage import LocalStorage, LocalConfig
-from .s3_storage import S3Config, S3Storage
-from .gd_storage import GDConfig, GDStorage
\ No newline at end of file
+
+# S3 and Google Drive pull in heavy client libraries (boto3, googleapiclient, ...) so they are only imported on first use
+_LAZY_IMPORTS = {
+    "S3Config": ".s3_storage",
+    "S3Storage": ".s3_storage",
+    "GDConfig": ".gd_storage",
+    "GDStorage": ".gd_storage",
+}
+
+
+def __getattr__(name):
+    if name in _LAZY_IMPORTS:
+        return getattr(importlib.import_module(_LAZY_IMPORTS[name], __name__), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
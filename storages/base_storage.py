@@ -1,10 +1,52 @@
+import hashlib
+
 from loguru import logger
 from abc import ABC, abstractmethod
 from pathlib import Path
 
 
+class HashingReader:
+    """
+    Wraps a binary file reader and hashes the bytes as the uploader reads them,
+    so the file does not have to be read a second time just to hash it.
+    Uploaders may seek back and re-read (eg: retries), only bytes past what has
+    already been hashed are fed to the hash.
+    """
+
+    def __init__(self, file, hash_factory=hashlib.sha256):
+        self.file = file
+        self.hash = hash_factory()
+        self.hashed_upto = 0
+        self.skipped = False  # set when a read jumps past unhashed bytes
+
+    def read(self, size=-1):
+        position = self.file.tell()
+        data = self.file.read(size)
+        if position > self.hashed_upto:
+            self.skipped = True
+        elif position + len(data) > self.hashed_upto:
+            self.hash.update(data[self.hashed_upto - position:])
+            self.hashed_upto = position + len(data)
+        return data
+
+    def hexdigest(self):
+        """
+        returns the hash of the whole file, or None if the uploader did not read all of it in order
+        """
+        position = self.file.tell()
+        size = self.file.seek(0, 2)
+        self.file.seek(position)
+        if self.skipped or self.hashed_upto != size: return None
+        return self.hash.hexdigest()
+
+    def __getattr__(self, name):
+        # seek, tell, fileno, ... go straight to the wrapped file
+        return getattr(self.file, name)
+
+
 class Storage(ABC):
     TMP_FOLDER = "tmp/"
+    READ_BUFFER_SIZE = 1 << 20
 
     @abstractmethod
     def __init__(self, config): pass
@@ -19,6 +61,12 @@ class Storage(ABC):
     def uploadf(self, file, key, **kwargs): pass
 
     def upload(self, filename: str, key: str, **kwargs):
+        """
+        uploads @filename to @key and returns its sha256 hexdigest, computed while uploading
+        returns None if the storage did not read the file in a way that allowed hashing it
+        """
         logger.debug(f'[{self.__class__.__name__}] uploading file {filename} with key {key}')
-        with open(filename, 'rb') as f:
-            self.uploadf(f, key, **kwargs)
+        with open(filename, 'rb', buffering=Storage.READ_BUFFER_SIZE) as f:
+            reader = HashingReader(f)
+            self.uploadf(reader, key, **kwargs)
+            return reader.hexdigest()
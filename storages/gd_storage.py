@@ -1,11 +1,15 @@
-import os, time
+import os, time, threading, mimetypes
 
 from loguru import logger
 from .base_storage import Storage
 from dataclasses import dataclass
 from googleapiclient.discovery import build
-from googleapiclient.http import MediaFileUpload
+from googleapiclient.errors import HttpError
+from googleapiclient.http import MediaIoBaseUpload, build_http
 from google.oauth2 import service_account
+from google_auth_httplib2 import AuthorizedHttp
+
+from utils import MetadataCache
 
 
 @dataclass
@@ -16,52 +20,72 @@ class GDConfig:
 
 
 class GDStorage(Storage):
+    # the Drive API only recommends single-request multipart uploads for small files
+    MULTIPART_MAX_BYTES = 5 * 1024 * 1024
+    # large chunks mean fewer round-trips per resumable upload, must be a multiple of 256KB
+    CHUNK_SIZE = 16 * 1024 * 1024
+    CHUNK_RETRIES = 3
+    FOLDER_MIME_TYPE = "application/vnd.google-apps.folder"
+    CACHE_FILENAME = ".gd_cache.sqlite"
+    CACHE_TTL = 7 * 24 * 60 * 60
+    HTTP_TIMEOUT = 30
+
     def __init__(self, config: GDConfig):
         self.folder = config.folder
         self.root_folder_id = config.root_folder_id
-        creds = service_account.Credentials.from_service_account_file(
+        self.creds = service_account.Credentials.from_service_account_file(
             config.service_account, scopes=['https://www.googleapis.com/auth/drive'])
-        self.service = build('drive', 'v3', credentials=creds)
+        # httplib2 is not thread-safe and uploads may run in a background pool, so each thread gets its own transport
+        self._local = threading.local()
+        # the discovery document is bundled with googleapiclient so skip the discovery cache lookup
+        self.service = build('drive', 'v3', http=self._http(), cache_discovery=False)
+        # folder lookups and creations are serialized so concurrent uploads do not create the same folder twice
+        self.lock = threading.RLock()
+        # folder ids persist across runs so the same hierarchy is not walked every time, file ids only for this run
+        self.api_cache = MetadataCache.shared(GDStorage.CACHE_FILENAME, max_age=GDStorage.CACHE_TTL)
+        self.file_id_cache = {}
+        # folder ids listed or created by the API during this run, cached ids outside it are checked once before being uploaded to
+        self._verified_folders = set()
+        self._warm_cache(self.root_folder_id)
+
+    @property
+    def folder(self):
+        return self._folder
+
+    @folder.setter
+    def folder(self, folder):
+        # split once per folder change rather than on every lookup
+        self._folder = folder
+        self._folder_parts = tuple(part for part in folder.split('/') if part)
 
     def get_cdn_url(self, key):
         """
         only support files saved in a folder for GD
         S3 supports folder and all stored in the root
         """
-        full_name = os.path.join(self.folder, key)
-        parent_id, folder_id = self.root_folder_id, None
-        path_parts = full_name.split(os.path.sep)
-        filename = path_parts[-1]
-        logger.info(f"looking for folders for {path_parts[0:-1]} before uploading {filename=}")
-        for folder in path_parts[0:-1]:
-            folder_id = self._get_id_from_parent_and_name(parent_id, folder, use_mime_type=True, raise_on_missing=True)
-            parent_id = folder_id
-
-        # get id of file inside folder (or sub folder)
-        file_id = self._get_id_from_parent_and_name(folder_id, filename)
+        file_id = self._lookup_key(key)
+        if file_id is None:
+            raise ValueError(f'[searching {key=} in {self.folder}] not found')
         return f"https://drive.google.com/file/d/{file_id}/view?usp=sharing"
 
     def exists(self, key):
-        try:
-            self.get_cdn_url(key)
-            return True
-        except: return False
+        return self._lookup_key(key) is not None
+
+    def _lookup_key(self, key):
+        """
+        Returns the id of the file saved under @key, or None if it (or any of its folders) does not exist
+        """
+        parent_id, filename = self._walk_to_parent(self._key_parts(key))
+        if parent_id is None: return None
+        # get id of file inside folder (or sub folder)
+        return self._get_id_from_parent_and_name(parent_id, filename, raise_on_missing=False)
 
-    def uploadf(self, file: str, key: str, **_kwargs):
+    def uploadf(self, file, key: str, **_kwargs):
         """
         1. for each sub-folder in the path check if exists or create
         2. upload file to root_id/other_paths.../filename
         """
-        full_name = os.path.join(self.folder, key)
-        parent_id, upload_to = self.root_folder_id, None
-        path_parts = full_name.split(os.path.sep)
-        filename = path_parts[-1]
-        logger.info(f"checking folders {path_parts[0:-1]} exist (or creating) before uploading {filename=}")
-        for folder in path_parts[0:-1]:
-            upload_to = self._get_id_from_parent_and_name(parent_id, folder, use_mime_type=True, raise_on_missing=False)
-            if upload_to is None:
-                upload_to = self._mkdir(folder, parent_id)
-            parent_id = upload_to
+        upload_to, filename = self._walk_to_parent(self._key_parts(key), create=True)
 
         # upload file to gd
         logger.debug(f'uploading {filename=} to folder id {upload_to}')
@@ -69,13 +93,85 @@ class GDStorage(Storage):
             'name': [filename],
             'parents': [upload_to]
         }
-        media = MediaFileUpload(file, resumable=True)
-        gd_file = self.service.files().create(body=file_metadata, media_body=media, fields='id').execute()
+        mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        size = file.seek(0, os.SEEK_END)
+        file.seek(0)
+        if size <= GDStorage.MULTIPART_MAX_BYTES:
+            # small files go in a single request, skipping the resumable session round-trip
+            media = MediaIoBaseUpload(file, mimetype=mimetype, resumable=False)
+            gd_file = self.service.files().create(body=file_metadata, media_body=media, fields='id').execute(http=self._http(), num_retries=GDStorage.CHUNK_RETRIES)
+        else:
+            media = MediaIoBaseUpload(file, mimetype=mimetype, chunksize=GDStorage.CHUNK_SIZE, resumable=True)
+            request = self.service.files().create(body=file_metadata, media_body=media, fields='id')
+            gd_file = None
+            while gd_file is None:
+                # transient errors are retried per chunk rather than restarting the whole upload
+                status, gd_file = request.next_chunk(http=self._http(), num_retries=GDStorage.CHUNK_RETRIES)
+                if status: logger.debug(f'uploaded {int(status.progress() * 100)}% of {filename=}')
         logger.debug(f'uploadf: uploaded file {gd_file["id"]} succesfully in folder={upload_to}')
 
-    def upload(self, filename: str, key: str, **kwargs):
-        # GD only requires the filename not a file reader
-        self.uploadf(filename, key, **kwargs)
+    def _key_parts(self, key: str):
+        return self._folder_parts + tuple(key.split('/'))
+
+    def _walk_to_parent(self, path_parts: tuple, create: bool = False):
+        """
+        Finds the folder containing the last of @path_parts, going through each of the others from the root folder
+        If @create the missing folders are created, otherwise the returned id is None when any is missing
+        Returns the id of that folder and the filename (last of @path_parts)
+        """
+        with self.lock:
+            folders, filename = list(path_parts[0:-1]), path_parts[-1]
+            logger.info(f"looking for folders {folders} of {filename=}")
+            parent_id = self._walk_folders(folders, create)
+            # folder ids may come from the persisted cache, do not upload into a folder deleted or trashed since
+            if create and len(folders) and parent_id not in self._verified_folders:
+                if not self._is_live_folder(parent_id):
+                    logger.warning(f"cached folder {parent_id} of {folders} no longer exists, looking it up again")
+                    self._forget_folders(folders)
+                    parent_id = self._walk_folders(folders, create)
+                self._verified_folders.add(parent_id)
+            return parent_id, filename
+
+    def _walk_folders(self, folders: list, create: bool):
+        parent_id = self.root_folder_id
+        for folder, folder_id in zip(folders, self._resolve_path(parent_id, folders)):
+            if folder_id is None:
+                if not create: return None
+                folder_id = self._mkdir(folder, parent_id)
+            parent_id = folder_id
+        return parent_id
+
+    def _is_live_folder(self, folder_id: str):
+        try:
+            folder = self.service.files().get(fileId=folder_id, fields='trashed').execute(http=self._http())
+            return not folder.get('trashed', False)
+        except HttpError as e:
+            if e.resp.status == 404: return False
+            raise e
+
+    def _forget_folders(self, folders: list):
+        """
+        Removes the cached ids of the nested @folders from the persisted cache
+        """
+        parent_id = self.root_folder_id
+        for folder in folders:
+            cache_key = self._cache_key(parent_id, folder, True)
+            parent_id = self.api_cache.get(cache_key, ttl=GDStorage.CACHE_TTL)
+            self.api_cache.delete(cache_key)
+            if parent_id is None: break
+
+    def _http(self):
+        if not hasattr(self._local, "http"):
+            self._local.http = self._build_http()
+        return self._local.http
+
+    def _build_http(self):
+        """
+        googleapiclient's build_http removes 308 from the httplib2 redirect codes, which resumable uploads rely on
+        """
+        http = build_http()
+        http.timeout = GDStorage.HTTP_TIMEOUT
+        return AuthorizedHttp(self.creds, http=http)
 
     def _get_id_from_parent_and_name(self, parent_id: str, name: str, retries: int = 1, sleep_seconds: int = 10, use_mime_type: bool = False, raise_on_missing: bool = True, use_cache=True):
         """
@@ -84,45 +180,104 @@ class GDStorage(Storage):
         If @use_mime_type will restrict search to "mimeType='application/vnd.google-apps.folder'"
         If @raise_on_missing will throw error when not found, or returns None
         Will remember previous calls to avoid duplication if @use_cache
-        Returns the id of the file or folder from its name as a string
+        Returns the id of the file or folder from its name as a string, the most recent one if there are several
         """
-        # cache logic
+        # cache logic, only folder ids are persisted as files are more likely to be deleted
         if use_cache:
-            self.api_cache = getattr(self, "api_cache", {})
-            cache_key = f"{parent_id}_{name}_{use_mime_type}"
-            if cache_key in self.api_cache:
-                logger.debug(f"cache hit for {cache_key=}")
-                return self.api_cache[cache_key]
+            cache_key = self._cache_key(parent_id, name, use_mime_type)
+            if use_mime_type:
+                cached_id = self.api_cache.get(cache_key, ttl=GDStorage.CACHE_TTL)
+            else:
+                cached_id = self.file_id_cache.get(cache_key)
+            if cached_id is not None:
+                return cached_id
 
         # API logic
         debug_header: str = f"[searching {name=} in {parent_id=}]"
-        query_string = f"'{parent_id}' in parents and name = '{name}' "
+        query_string = f"'{parent_id}' in parents and name = '{name}' and trashed = false "
         if use_mime_type:
-            query_string += f" and mimeType='application/vnd.google-apps.folder' "
+            query_string += f" and mimeType='{GDStorage.FOLDER_MIME_TYPE}' "
 
-        for attempt in range(retries):
-            results = self.service.files().list(
-                q=query_string,
-                spaces='drive',  # ie not appDataFolder or photos
-                fields='files(id, name)'
-            ).execute()
-            items = results.get('files', [])
-
-            if len(items) > 0:
-                logger.debug(f"{debug_header} found {len(items)} matches, returning last of {','.join([i['id'] for i in items])}")
-                _id = items[-1]['id']
-                if use_cache: self.api_cache[cache_key] = _id
-                return _id
-            else:
-                logger.debug(f'{debug_header} not found, attempt {attempt+1}/{retries}.')
-                if attempt < retries - 1:
-                    logger.debug(f'sleeping for {sleep_seconds} second(s)')
-                    time.sleep(sleep_seconds)
+        _id = self._query_id(query_string)
+        # only loops (and sleeps) when more than one attempt was requested
+        for attempt in range(1, retries):
+            if _id is not None: break
+            logger.debug(f'{debug_header} not found, attempt {attempt}/{retries}, sleeping for {sleep_seconds} second(s)')
+            time.sleep(sleep_seconds)
+            _id = self._query_id(query_string)
+
+        if _id is not None:
+            logger.debug(f"{debug_header} found {_id}")
+            if use_cache:
+                if use_mime_type: self.api_cache.set(cache_key, _id)
+                else: self.file_id_cache[cache_key] = _id
+            return _id
 
         if raise_on_missing:
             raise ValueError(f'{debug_header} not found after {retries} attempt(s)')
         return None
 
+    def _query_id(self, query_string: str):
+        """
+        Returns the id of the most recently created file or folder matching @query_string, or None
+        Only that id is requested to keep the response minimal
+        """
+        results = self.service.files().list(
+            q=query_string,
+            spaces='drive',  # ie not appDataFolder or photos
+            fields='files(id)',
+            orderBy='createdTime desc',
+            pageSize=1
+        ).execute(http=self._http())
+        items = results.get('files', [])
+        return items[0]['id'] if len(items) else None
+
+    def _resolve_path(self, parent_id: str, path_parts: list):
+        """
+        Retrieves the ids of the nested folders @path_parts starting inside @parent_id
+        Uncached folders are found with a single API call querying all their names at once,
+        the parent->child chain is then rebuilt locally from each result's parents
+        Returns a list of ids aligned with @path_parts, None from the first missing folder onwards
+        """
+        folder_ids = []
+        for folder in path_parts:
+            cached_id = self.api_cache.get(self._cache_key(parent_id, folder, True), ttl=GDStorage.CACHE_TTL)
+            if cached_id is None: break
+            folder_ids.append(cached_id)
+            parent_id = cached_id
+
+        missing = path_parts[len(folder_ids):]
+        if len(missing) == 0: return folder_ids
+
+        names_query = " or ".join(f"name = '{folder}'" for folder in sorted(set(missing)))
+        found, page_token = {}, None
+        while True:
+            results = self.service.files().list(
+                q=f"mimeType='{GDStorage.FOLDER_MIME_TYPE}' and trashed = false and ({names_query})",
+                spaces='drive',
+                fields='nextPageToken, files(id, name, parents)',
+                orderBy='createdTime',
+                pageSize=1000,
+                pageToken=page_token
+            ).execute(http=self._http())
+            for item in results.get('files', []):
+                # if there are several folders with the same name in a parent, the newest (last listed) wins like in _query_id
+                for item_parent_id in item.get('parents', []):
+                    found[(item_parent_id, item['name'])] = item['id']
+            page_token = results.get('nextPageToken')
+            if page_token is None: break
+
+        for folder in missing:
+            folder_id = found.get((parent_id, folder))
+            if folder_id is None: break
+            self.api_cache.set(self._cache_key(parent_id, folder, True), folder_id)
+            self._verified_folders.add(folder_id)
+            folder_ids.append(folder_id)
+            parent_id = folder_id
+
+        logger.debug(f"resolved {len(folder_ids)}/{len(path_parts)} folders of {path_parts}")
+        return folder_ids + [None] * (len(path_parts) - len(folder_ids))
+
     def _mkdir(self, name: str, parent_id: str):
         """
         Creates a new GDrive folder @name inside folder @parent_id
@@ -131,8 +286,33 @@ class GDStorage(Storage):
         logger.debug(f'Creating new folder with {name=} inside {parent_id=}')
         file_metadata = {
             'name': [name],
-            'mimeType': 'application/vnd.google-apps.folder',
+            'mimeType': GDStorage.FOLDER_MIME_TYPE,
             'parents': [parent_id]
         }
-        gd_folder = self.service.files().create(body=file_metadata, fields='id').execute()
+        gd_folder = self.service.files().create(body=file_metadata, fields='id').execute(http=self._http())
+        self.api_cache.set(self._cache_key(parent_id, name, True), gd_folder.get('id'))
+        self._verified_folders.add(gd_folder.get('id'))
         return gd_folder.get('id')
+
+    def _warm_cache(self, parent_id: str):
+        """
+        Lists all the sub-folders of @parent_id (1000 per request) and caches their ids
+        so that later lookups inside that folder do not need one API call each
+        """
+        page_token = None
+        while True:
+            results = self.service.files().list(
+                q=f"'{parent_id}' in parents and mimeType='{GDStorage.FOLDER_MIME_TYPE}' and trashed = false",
+                spaces='drive',
+                fields='nextPageToken, files(id, name)',
+                pageSize=1000,
+                pageToken=page_token
+            ).execute(http=self._http())
+            self.api_cache.set_many({self._cache_key(parent_id, item['name'], True): item['id'] for item in results.get('files', [])})
+            self._verified_folders.update(item['id'] for item in results.get('files', []))
+            page_token = results.get('nextPageToken')
+            if page_token is None: break
+        logger.debug(f'warmed GD cache with the children of {parent_id=}')
+
+    def _cache_key(self, parent_id: str, name: str, use_mime_type: bool):
+        return f"{parent_id}_{name}_{use_mime_type}"
@@ -1,3 +1,4 @@
 # we need to explicitly expose the available imports here
 from .gworksheet import *
-from .misc import *
\ No newline at end of file
+from .misc import *
+from .metadata_cache import *
\ No newline at end of file
@@ -0,0 +1,76 @@
+import json, sqlite3, threading, time
+
+from loguru import logger
+
+
+class MetadataCache:
+    """
+    Persists small JSON-serializable metadata on disk, keyed by URL (or any
+    other string), so that re-running the same sheet does not repeat the
+    network lookups.
+    Usage:
+      cache = MetadataCache.shared(max_age=86400)
+      info = cache.get_or_compute(url, ttl=86400, fn=lambda: lookup(url))
+    Entries older than @ttl seconds are recomputed, and those older than @max_age are deleted when the file is opened.
+    """
+    _shared = {}
+    _shared_lock = threading.Lock()
+
+    def __init__(self, filename: str = ".metadata_cache.sqlite", max_age: int = None):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS metadata (url TEXT PRIMARY KEY, json BLOB, ts INT)")
+        if max_age is not None:
+            # expired entries are never read again, so drop them to keep the file from growing forever
+            deleted = self.db.execute("DELETE FROM metadata WHERE ts < ?", (int(time.time()) - max_age,)).rowcount
+            logger.debug(f"removed {deleted} expired entries from {filename}")
+        self.db.commit()
+
+    @classmethod
+    def shared(cls, filename: str = ".metadata_cache.sqlite", max_age: int = None):
+        """
+        Returns the cache for @filename shared by the whole process, opening it on first use
+        so that objects created for every worksheet do not each open (and leave open) a connection
+        """
+        with cls._shared_lock:
+            if filename not in cls._shared:
+                cls._shared[filename] = cls(filename, max_age)
+            return cls._shared[filename]
+
+    def get(self, url: str, ttl: int):
+        with self.lock:
+            row = self.db.execute("SELECT json, ts FROM metadata WHERE url = ?", (url,)).fetchone()
+        if row is None or time.time() - row[1] > ttl:
+            return None
+        logger.debug(f"metadata cache hit for {url=}")
+        return json.loads(row[0])
+
+    def set(self, url: str, value):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO metadata (url, json, ts) VALUES (?, ?, ?)", (url, json.dumps(value), int(time.time())))
+            self.db.commit()
+
+    def set_many(self, values: dict):
+        """
+        Stores every url: value pair of @values in a single transaction
+        """
+        now = int(time.time())
+        with self.lock:
+            self.db.executemany("INSERT OR REPLACE INTO metadata (url, json, ts) VALUES (?, ?, ?)", [(url, json.dumps(value), now) for url, value in values.items()])
+            self.db.commit()
+
+    def delete(self, url: str):
+        with self.lock:
+            self.db.execute("DELETE FROM metadata WHERE url = ?", (url,))
+            self.db.commit()
+
+    def get_or_compute(self, url: str, ttl: int, fn, cache_if=None):
+        """
+        Returns the cached value for @url if younger than @ttl seconds, otherwise calls @fn and caches its result
+        @fn may return None, in which case nothing is cached, and @cache_if(value) can veto caching other results
+        """
+        value = self.get(url, ttl)
+        if value is None:
+            value = fn()
+            if value is not None and (cache_if is None or cache_if(value)): self.set(url, value)
+        return value
@@ -5,8 +5,8 @@ from loguru import logger
 
 
 def mkdir_if_not_exists(folder):
-    if not os.path.exists(folder):
-        os.makedirs(folder)
+    # exist_ok since uploads may run concurrently and race to create the same folder
+    os.makedirs(folder, exist_ok=True)
 
 
 def expand_url(url):